@@ -8,20 +8,25 @@ import os
 import re
 import hmac
 import hashlib
+import sys
 import logging
-import json
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import uuid
 import asyncio
 import sqlite3
-from datetime import datetime, timedelta
+import threading
+from datetime import datetime, timedelta, timezone
 from typing import Optional
-from contextlib import asynccontextmanager
+from functools import lru_cache
+from contextlib import asynccontextmanager, contextmanager
 
 import jwt
 import httpx
+import orjson
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -36,6 +41,10 @@ clerk_sdk = None
 if CLERK_SECRET_KEY:
     clerk_sdk = Clerk(bearer_auth=CLERK_SECRET_KEY)
 
+# PyJWKClient keeps its own key cache, so build it once instead of per token
+CLERK_JWKS_URL = os.getenv("CLERK_JWKS_URL", "https://organic-mayfly-21.clerk.accounts.dev/.well-known/jwks.json")
+jwks_client = jwt.PyJWKClient(CLERK_JWKS_URL, cache_keys=True, lifespan=3600)
+
 # Configuration
 DEBUG = os.getenv("DEBUG", "true").lower() == "true"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -49,13 +58,24 @@ if not JWT_SECRET:
     raise ValueError("JWT_SECRET environment variable is required")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_DAYS = 30
+SESSION_TOKEN_SECONDS = 600  # lifetime of the reconnect token issued after a full Clerk + CRM check
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "chat.db"))
 LOG_PATH = os.getenv("LOG_PATH", os.path.join(BASE_DIR, "debug.log"))
 
 zoho_token_cache = {"access_token": None, "expires_at": None}
+zoho_token_lock = asyncio.Lock()
+http_client: Optional[httpx.AsyncClient] = None  # shared pool, opened in lifespan
+db_conn: Optional[sqlite3.Connection] = None  # long-lived connection, opened in init_db
+db_lock = threading.RLock()
 active_sessions = {}
+clerk_user_cache = {}  # clerk_user_id -> ((email, name, picture), expires_at)
+CLERK_USER_CACHE_TTL = 300
+CLERK_USER_CACHE_SIZE = 2048
+crm_record_cache = {}  # (module, fields, email) -> (record, expires_at)
+CRM_CACHE_TTL = 300
+CRM_CACHE_SIZE = 4096
 webhook_rate_limit = {}  # IP -> (count, timestamp)
 
 def check_rate_limit(ip: str, limit: int = 10, window: int = 60) -> bool:
@@ -94,20 +114,49 @@ def sanitize_email(email: str) -> str:
     sanitized = sanitized.replace('"', '').replace("'", '')
     return sanitized.lower()
 
+class CachedTimeFormatter(logging.Formatter):
+    """Formatter that only re-runs strftime when the record's second changes."""
+    cached_time = (None, "")
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        if second != self.cached_time[0]:
+            self.cached_time = (second, super().formatTime(record, datefmt))
+        return self.cached_time[1]
+
+# Handlers run on a QueueListener thread, so logging from async handlers never touches disk on the event loop
+log_formatter = CachedTimeFormatter("[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+log_file_handler = RotatingFileHandler(LOG_PATH, maxBytes=10_000_000, backupCount=3)
+log_console_handler = logging.StreamHandler(sys.stdout)
+for handler in (log_file_handler, log_console_handler):
+    handler.setFormatter(log_formatter)
+log_queue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+# Started and stopped in lifespan; records logged before startup wait in the queue
+log_listener = QueueListener(log_queue, log_file_handler, log_console_handler)
+# DEBUG only applies to our own logger; httpx/h2 debug output would swamp the log
+logger = logging.getLogger("alfa_chatbot")
+logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+# httpx logs every request URL at INFO, query string included; keep those out of the log
+for noisy_logger in ("httpx", "httpcore"):
+    logging.getLogger(noisy_logger).setLevel(logging.WARNING)
+
 def log(message: str):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    msg = f"[{timestamp}] {message}"
-    print(msg)
-    with open(LOG_PATH, "a") as f:
-        f.write(msg + "\n")
+    logger.info(message)
 
 def debug(message: str):
-    if DEBUG:
-        log(f"[DEBUG] {message}")
+    logger.debug("[DEBUG] %s", message)
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    global db_conn
+    db_conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    db_conn.row_factory = sqlite3.Row
+    c = db_conn.cursor()
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute("PRAGMA cache_size=-64000")
+    c.execute("PRAGMA mmap_size=268435456")
     c.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -135,73 +184,130 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     """)
-    conn.commit()
-    conn.close()
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_email_lower ON users(lower(email))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_clerk ON users(clerk_user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations(user_id)")
+    # One row per chat message so each turn only appends; conversations.messages is kept for older rows
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT,
+            extra TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (conversation_id, seq),
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+        )
+    """)
+    db_conn.commit()
     log("Database initialized")
 
 def get_user_by_email(email: str) -> Optional[dict]:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE email = ?", (email.lower(),))
-    row = c.fetchone()
-    conn.close()
+    with db_lock:
+        row = db_conn.execute("SELECT * FROM users WHERE lower(email) = ?", (email.lower(),)).fetchone()
     return dict(row) if row else None
 
 def create_or_update_user(email: str, name: str, picture: str, clerk_user_id: str = None, crm_id: str = None, crm_data: dict = None) -> int:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    existing = get_user_by_email(email)
-    if existing:
-        c.execute("UPDATE users SET name = ?, picture = ?, clerk_user_id = ?, crm_id = ?, crm_data = ?, last_login = ? WHERE email = ?",
-                  (name, picture, clerk_user_id, crm_id, json.dumps(crm_data) if crm_data else None, datetime.now(), email.lower()))
-        user_id = existing["id"]
-    else:
-        c.execute("INSERT INTO users (email, name, picture, clerk_user_id, crm_id, crm_data, last_login) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                  (email.lower(), name, picture, clerk_user_id, crm_id, json.dumps(crm_data) if crm_data else None, datetime.now()))
-        user_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    with db_lock:
+        existing = get_user_by_email(email)
+        if existing:
+            db_conn.execute("UPDATE users SET name = ?, picture = ?, clerk_user_id = ?, crm_id = ?, crm_data = ?, last_login = ? WHERE lower(email) = ?",
+                            (name, picture, clerk_user_id, crm_id, orjson.dumps(crm_data).decode() if crm_data else None, datetime.now(), email.lower()))
+            user_id = existing["id"]
+        else:
+            c = db_conn.execute("INSERT INTO users (email, name, picture, clerk_user_id, crm_id, crm_data, last_login) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (email.lower(), name, picture, clerk_user_id, crm_id, orjson.dumps(crm_data).decode() if crm_data else None, datetime.now()))
+            user_id = c.lastrowid
+        db_conn.commit()
     return user_id
 
-def save_conversation(user_id: int, messages: list, conversation_id: int = None) -> int:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    if conversation_id:
-        c.execute("UPDATE conversations SET messages = ?, updated_at = ? WHERE id = ? AND user_id = ?",
-                  (json.dumps(messages), datetime.now(), conversation_id, user_id))
-    else:
-        c.execute("INSERT INTO conversations (user_id, messages) VALUES (?, ?)", (user_id, json.dumps(messages)))
-        conversation_id = c.lastrowid
-    conn.commit()
-    conn.close()
+def save_conversation(user_id: int, new_messages: list, conversation_id: int = None, start_seq: int = 0) -> int:
+    """Append new_messages to a conversation, numbering them from start_seq.
+
+    Starts a new conversation if conversation_id is unset or not owned by user_id.
+    """
+    rows = []
+    for i, message in enumerate(new_messages):
+        extra = {k: v for k, v in message.items() if k not in ("role", "content")}
+        rows.append((start_seq + i, message["role"], message.get("content"), orjson.dumps(extra).decode() if extra else None))
+    with db_lock:
+        if conversation_id:
+            c = db_conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ? AND user_id = ?",
+                                (datetime.now(), conversation_id, user_id))
+            if c.rowcount == 0:
+                conversation_id = None
+        if not conversation_id:
+            c = db_conn.execute("INSERT INTO conversations (user_id, messages) VALUES (?, ?)", (user_id, "[]"))
+            conversation_id = c.lastrowid
+        db_conn.executemany("INSERT INTO conversation_messages (conversation_id, seq, role, content, extra) VALUES (?, ?, ?, ?, ?)",
+                            [(conversation_id,) + row for row in rows])
+        db_conn.commit()
     return conversation_id
 
+def save_synced_users(rows: list):
+    """Insert (email, name, clerk_user_id) rows from the CRM sync in a single transaction."""
+    with db_lock:
+        db_conn.executemany("INSERT OR IGNORE INTO users (email, name, clerk_user_id) VALUES (?, ?, ?)", rows)
+        db_conn.commit()
+
 def verify_jwt_token(token: str) -> Optional[dict]:
     try:
         return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except:
         return None
 
+def create_session_token(identity: dict) -> str:
+    exp = datetime.now(timezone.utc) + timedelta(seconds=SESSION_TOKEN_SECONDS)
+    return jwt.encode({**identity, "exp": exp}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+def verify_session_token(session_token: str, clerk_token: str) -> Optional[dict]:
+    """Return the identity in a valid session token, provided the Clerk token is valid and for the same user.
+
+    The Clerk token is still verified against the cached JWKS keys; only the Clerk user
+    and CRM lookups are skipped.
+    """
+    identity = verify_jwt_token(session_token) if session_token else None
+    if not identity or "user_id" not in identity:
+        return None
+    try:
+        signing_key = jwks_client.get_signing_key_from_jwt(clerk_token)
+        sub = jwt.decode(clerk_token, signing_key.key, algorithms=["RS256"], options={"verify_aud": False}).get("sub")
+    except jwt.PyJWTError:
+        return None
+    return identity if sub and sub == identity.get("clerk_user_id") else None
+
+async def get_clerk_user(clerk_user_id: str) -> tuple:
+    """Return (email, name, picture) for a Clerk user, cached for CLERK_USER_CACHE_TTL seconds."""
+    now = datetime.now()
+    cached = clerk_user_cache.get(clerk_user_id)
+    if cached and now < cached[1]:
+        return cached[0]
+    email = name = picture = None
+    user = await asyncio.to_thread(clerk_sdk.users.get, user_id=clerk_user_id)
+    if user:
+        if user.email_addresses:
+            email = user.email_addresses[0].email_address
+        name = f"{user.first_name or ''} {user.last_name or ''}".strip()
+        picture = user.image_url
+    if email:
+        if len(clerk_user_cache) >= CLERK_USER_CACHE_SIZE:
+            clerk_user_cache.pop(next(iter(clerk_user_cache)))
+        clerk_user_cache[clerk_user_id] = ((email, name, picture), now + timedelta(seconds=CLERK_USER_CACHE_TTL))
+    return email, name, picture
+
 async def verify_clerk_token(token: str) -> Optional[dict]:
     if not clerk_sdk:
         return None
     try:
-        from jwt import PyJWKClient
-        jwks_url = os.getenv("CLERK_JWKS_URL", "https://organic-mayfly-21.clerk.accounts.dev/.well-known/jwks.json")
-        jwks_client = PyJWKClient(jwks_url)
         signing_key = jwks_client.get_signing_key_from_jwt(token)
         payload = jwt.decode(token, signing_key.key, algorithms=["RS256"], options={"verify_aud": False})
         clerk_user_id = payload.get("sub")
         email = name = picture = None
         if clerk_user_id:
             try:
-                user = clerk_sdk.users.get(user_id=clerk_user_id)
-                if user:
-                    if user.email_addresses:
-                        email = user.email_addresses[0].email_address
-                    name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-                    picture = user.image_url
+                email, name, picture = await get_clerk_user(clerk_user_id)
             except Exception as e:
                 log(f"Failed to fetch user from Clerk: {e}")
         if not email:
@@ -212,95 +318,128 @@ async def verify_clerk_token(token: str) -> Optional[dict]:
         log(f"Error verifying Clerk token: {e}")
         return None
 
-async def get_zoho_access_token() -> Optional[str]:
-    global zoho_token_cache
+def cached_zoho_access_token() -> Optional[str]:
     if zoho_token_cache["access_token"] and zoho_token_cache["expires_at"] and datetime.now() < zoho_token_cache["expires_at"]:
         return zoho_token_cache["access_token"]
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post("https://accounts.zoho.com/oauth/v2/token",
-                params={"refresh_token": ZOHO_REFRESH_TOKEN, "client_id": ZOHO_CLIENT_ID, "client_secret": ZOHO_CLIENT_SECRET, "grant_type": "refresh_token"})
-            data = response.json()
+    return None
+
+async def get_zoho_access_token() -> Optional[str]:
+    token = cached_zoho_access_token()
+    if token:
+        return token
+    # Only one coroutine refreshes; the rest wait and pick up the new token
+    async with zoho_token_lock:
+        token = cached_zoho_access_token()
+        if token:
+            return token
+        try:
+            response = await http_client.post("https://accounts.zoho.com/oauth/v2/token",
+                data={"refresh_token": ZOHO_REFRESH_TOKEN, "client_id": ZOHO_CLIENT_ID, "client_secret": ZOHO_CLIENT_SECRET, "grant_type": "refresh_token"})
+            data = orjson.loads(response.content)
             if "access_token" in data:
                 zoho_token_cache["access_token"] = data["access_token"]
                 zoho_token_cache["expires_at"] = datetime.now() + timedelta(seconds=data.get("expires_in", 3600) - 300)
                 debug("Zoho access token refreshed")
                 return data["access_token"]
-    except Exception as e:
-        log(f"Error refreshing Zoho token: {e}")
+        except Exception as e:
+            log(f"Error refreshing Zoho token: {e}")
     return None
 
-async def search_leads_by_email(email: str) -> Optional[dict]:
+def get_cached_crm_record(key: tuple) -> Optional[dict]:
+    cached = crm_record_cache.get(key)
+    if cached and datetime.now() < cached[1]:
+        return cached[0]
+    return None
+
+def cache_crm_record(key: tuple, record: dict):
+    if len(crm_record_cache) >= CRM_CACHE_SIZE:
+        crm_record_cache.pop(next(iter(crm_record_cache)))
+    crm_record_cache[key] = (record, datetime.now() + timedelta(seconds=CRM_CACHE_TTL))
+
+def evict_crm_email(email: str):
+    """Drop every cached CRM record for an email, e.g. after Zoho reports a change."""
+    email = sanitize_email(email)
+    for key in [k for k in crm_record_cache if k[2] == email]:
+        crm_record_cache.pop(key, None)
+
+LEAD_FIELDS = "id, First_Name, Last_Name, Email, Phone, Lead_Status, Language, Training_Status, Stage, Tier_Level, Candidate_Recruitment_Owner"
+LEAD_DOCUMENT_FIELDS = LEAD_FIELDS + ", Government_issued_ID, Background_check_report, Resume"
+LEAD_QUERY = 'select {fields} from Leads where Email = "{email}" limit 1'
+CONTACT_QUERY = 'select id, First_Name, Last_Name, Email, Phone from Contacts where Email = "{email}" limit 1'
+
+async def search_leads_by_email(email: str, fields: str = LEAD_FIELDS) -> Optional[dict]:
+    email = sanitize_email(email)
+    if not email:
+        return None
+    cache_key = ("Leads", fields, email)
+    cached = get_cached_crm_record(cache_key)
+    if cached:
+        return cached
     access_token = await get_zoho_access_token()
     if not access_token:
         return None
-    query = f'select id, First_Name, Last_Name, Email, Phone, Lead_Status, Language, Training_Status, Stage, Tier_Level, Candidate_Recruitment_Owner from Leads where Email = "{sanitize_email(email)}" limit 1'
+    query = LEAD_QUERY.format(fields=fields, email=email)
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post("https://www.zohoapis.com/crm/v8/coql",
-                headers={"Authorization": f"Zoho-oauthtoken {access_token}", "Content-Type": "application/json"},
-                json={"select_query": query})
-            data = response.json()
-            if "data" in data and len(data["data"]) > 0:
-                return data["data"][0]
+        response = await http_client.post("https://www.zohoapis.com/crm/v8/coql",
+            headers={"Authorization": f"Zoho-oauthtoken {access_token}", "Content-Type": "application/json"},
+            json={"select_query": query})
+        data = orjson.loads(response.content)
+        if "data" in data and len(data["data"]) > 0:
+            cache_crm_record(cache_key, data["data"][0])
+            return data["data"][0]
     except Exception as e:
         log(f"Error searching leads: {e}")
     return None
 
 async def search_contacts_by_email(email: str) -> Optional[dict]:
+    email = sanitize_email(email)
+    if not email:
+        return None
+    cache_key = ("Contacts", None, email)
+    cached = get_cached_crm_record(cache_key)
+    if cached:
+        return cached
     access_token = await get_zoho_access_token()
     if not access_token:
         return None
-    query = f'select id, First_Name, Last_Name, Email, Phone from Contacts where Email = "{sanitize_email(email)}" limit 1'
+    query = CONTACT_QUERY.format(email=email)
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post("https://www.zohoapis.com/crm/v8/coql",
-                headers={"Authorization": f"Zoho-oauthtoken {access_token}", "Content-Type": "application/json"},
-                json={"select_query": query})
-            data = response.json()
-            if "data" in data and len(data["data"]) > 0:
-                return data["data"][0]
+        response = await http_client.post("https://www.zohoapis.com/crm/v8/coql",
+            headers={"Authorization": f"Zoho-oauthtoken {access_token}", "Content-Type": "application/json"},
+            json={"select_query": query})
+        data = orjson.loads(response.content)
+        if "data" in data and len(data["data"]) > 0:
+            cache_crm_record(cache_key, data["data"][0])
+            return data["data"][0]
     except Exception as e:
         log(f"Error searching contacts: {e}")
     return None
 
+async def verify_clerk_token_warming_zoho(token: str) -> Optional[dict]:
+    """Verify a Clerk token while refreshing the Zoho token the CRM lookup that follows will need."""
+    if not clerk_sdk:
+        return None
+    payload, _ = await asyncio.gather(verify_clerk_token(token), get_zoho_access_token(), return_exceptions=True)
+    return payload if isinstance(payload, dict) else None
+
 async def verify_email_in_crm(email: str) -> tuple:
-    lead = await search_leads_by_email(email)
+    # Leads and Contacts are independent lookups; run them concurrently
+    lead, contact = await asyncio.gather(search_leads_by_email(email), search_contacts_by_email(email))
     if lead:
         return lead, "candidate"
-    contact = await search_contacts_by_email(email)
     if contact:
         return contact, "interpreter"
     return None, None
 
-async def get_lead_with_documents(email: str) -> Optional[dict]:
-    access_token = await get_zoho_access_token()
-    if not access_token:
-        return None
-    query = f'select id, First_Name, Last_Name, Email, Lead_Status, Language, Training_Status, Stage, Tier_Level, Candidate_Recruitment_Owner from Leads where Email = "{sanitize_email(email)}" limit 1'
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post("https://www.zohoapis.com/crm/v8/coql",
-                headers={"Authorization": f"Zoho-oauthtoken {access_token}", "Content-Type": "application/json"},
-                json={"select_query": query})
-            data = response.json()
-            if "data" not in data or len(data["data"]) == 0:
-                return None
-            lead = data["data"][0]
-            lead_id = lead.get("id")
-            if lead_id:
-                detail_response = await client.get(f"https://www.zohoapis.com/crm/v8/Leads/{lead_id}",
-                    headers={"Authorization": f"Zoho-oauthtoken {access_token}"})
-                detail_data = detail_response.json()
-                if "data" in detail_data and len(detail_data["data"]) > 0:
-                    full_lead = detail_data["data"][0]
-                    lead["Government_issued_ID"] = full_lead.get("Government_issued_ID")
-                    lead["Background_check_report"] = full_lead.get("Background_check_report")
-                    lead["Resume"] = full_lead.get("Resume")
-            return lead
-    except Exception as e:
-        log(f"Error fetching lead: {e}")
-    return None
+async def fetch_candidate(email: str) -> tuple:
+    """Like verify_email_in_crm, but a lead hit already carries the document fields."""
+    lead = await search_leads_by_email(email, LEAD_DOCUMENT_FIELDS)
+    if lead:
+        return lead, "candidate"
+    contact = await search_contacts_by_email(email)
+    if contact:
+        return contact, "interpreter"
+    return None, None
 
 async def lookup_application_status(email: str = None, **kwargs) -> dict:
     if email:
@@ -325,47 +464,96 @@ CHAT_TOOLS = [
     {"type": "function", "function": {"name": "transfer_to_human", "description": "Transfer to human",
         "parameters": {"type": "object", "properties": {"reason": {"type": "string"}}, "required": ["reason"]}}}
 ]
+# Tools never change, so encode them once and embed the bytes in each request
+CHAT_TOOLS_JSON = orjson.Fragment(orjson.dumps(CHAT_TOOLS))
 
-def get_system_prompt(user_data: dict = None, language: str = "en") -> str:
+@lru_cache(maxsize=1024)
+def build_system_prompt(name: Optional[str], email: Optional[str], has_user: bool, language: str) -> str:
     lang_note = "Respond in Spanish." if language == "es" else "Respond in English."
-    user_info = ""
-    if user_data:
-        user_info = f"\nUser: {user_data.get('name')} ({user_data.get('email')})"
+    user_info = f"\nUser: {name} ({email})" if has_user else ""
     return f"You are Angela, a helpful assistant for Alfa Interpreting. {lang_note}{user_info}"
 
-async def get_chat_response(messages: list, user_data: dict = None, language: str = "en") -> str:
+def get_system_prompt(user_data: dict = None, language: str = "en") -> str:
+    if user_data:
+        return build_system_prompt(user_data.get("name"), user_data.get("email"), True, language)
+    return build_system_prompt(None, None, False, language)
+
+STREAM_FLUSH_INTERVAL = 0.05  # seconds between message_delta frames
+
+async def stream_chat_completion(payload: dict, on_delta=None) -> Optional[dict]:
+    """Stream a chat completion, passing text deltas to on_delta in ~50ms batches. Returns the assembled message."""
+    content = []
+    pending = []
+    tool_calls = {}
+    loop = asyncio.get_running_loop()
+    last_flush = loop.time()
+    async with http_client.stream("POST", "https://api.openai.com/v1/chat/completions",
+            headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
+            content=orjson.dumps({**payload, "stream": True})) as response:
+        if response.status_code != 200:
+            log(f"OpenAI error {response.status_code}: {(await response.aread())[:200]}")
+            return None
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            if line == "data: [DONE]":
+                break
+            choices = orjson.loads(line[6:]).get("choices")
+            if not choices:
+                continue
+            delta = choices[0].get("delta", {})
+            if delta.get("content"):
+                content.append(delta["content"])
+                pending.append(delta["content"])
+            for tc in delta.get("tool_calls") or []:
+                entry = tool_calls.setdefault(tc["index"], {"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+                if tc.get("id"):
+                    entry["id"] = tc["id"]
+                fn = tc.get("function") or {}
+                entry["function"]["name"] += fn.get("name") or ""
+                entry["function"]["arguments"] += fn.get("arguments") or ""
+            if on_delta and pending and loop.time() - last_flush >= STREAM_FLUSH_INTERVAL:
+                await on_delta("".join(pending))
+                pending.clear()
+                last_flush = loop.time()
+    if on_delta and pending:
+        await on_delta("".join(pending))
+    message = {"role": "assistant", "content": "".join(content) or None}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+    return message
+
+async def get_chat_response(messages: list, user_data: dict = None, language: str = "en", on_delta=None) -> str:
     system_prompt = get_system_prompt(user_data, language)
     api_messages = [{"role": "system", "content": system_prompt}] + messages
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post("https://api.openai.com/v1/chat/completions",
-                headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
-                json={"model": "gpt-4o", "messages": api_messages, "tools": CHAT_TOOLS, "tool_choice": "auto", "temperature": 0.7})
-            data = response.json()
-            if "error" in data:
+        assistant_message = await stream_chat_completion(
+            {"model": "gpt-4o", "messages": api_messages, "tools": CHAT_TOOLS_JSON, "tool_choice": "auto", "temperature": 0.7}, on_delta)
+        if not assistant_message:
+            return "I'm having trouble. Please try again."
+        if assistant_message.get("tool_calls"):
+            messages.append(assistant_message)
+            for tool_call in assistant_message["tool_calls"]:
+                fn = tool_call["function"]["name"]
+                args = orjson.loads(tool_call["function"]["arguments"])
+                debug(f"Tool call: {fn}({args})")
+                if fn == "lookup_application_status":
+                    if user_data and "email" not in args:
+                        args["email"] = user_data.get("email")
+                    result = await lookup_application_status(**args)
+                elif fn == "search_knowledge_base":
+                    result = await search_knowledge_base(**args)
+                else:
+                    result = await transfer_to_human(**args)
+                messages.append({"role": "tool", "tool_call_id": tool_call["id"], "content": orjson.dumps(result).decode()})
+            api_messages = [{"role": "system", "content": system_prompt}] + messages
+            assistant_message = await stream_chat_completion(
+                {"model": "gpt-4o", "messages": api_messages, "temperature": 0.7}, on_delta)
+            if not assistant_message:
                 return "I'm having trouble. Please try again."
-            assistant_message = data["choices"][0]["message"]
-            if assistant_message.get("tool_calls"):
-                messages.append(assistant_message)
-                for tool_call in assistant_message["tool_calls"]:
-                    fn = tool_call["function"]["name"]
-                    args = json.loads(tool_call["function"]["arguments"])
-                    debug(f"Tool call: {fn}({args})")
-                    if fn == "lookup_application_status":
-                        if user_data and "email" not in args:
-                            args["email"] = user_data.get("email")
-                        result = await lookup_application_status(**args)
-                    elif fn == "search_knowledge_base":
-                        result = await search_knowledge_base(**args)
-                    else:
-                        result = await transfer_to_human(**args)
-                    messages.append({"role": "tool", "tool_call_id": tool_call["id"], "content": json.dumps(result)})
-                api_messages = [{"role": "system", "content": system_prompt}] + messages
-                final = await client.post("https://api.openai.com/v1/chat/completions",
-                    headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
-                    json={"model": "gpt-4o", "messages": api_messages, "temperature": 0.7})
-                assistant_message = final.json()["choices"][0]["message"]
-            return assistant_message["content"]
+        return assistant_message["content"] or ""
+    except WebSocketDisconnect:
+        raise
     except Exception as e:
         log(f"Chat error: {e}")
         return "I encountered an error. Please try again."
@@ -374,11 +562,10 @@ APPLICATION_STAGES = ["Application Review", "Candidate Interview", "Candidate La
     "Candidate ID/Background Verification", "Contract & Payment Setup", "Training Required",
     "Client Tool Orientation", "Interpreter Ready for Production"]
 
+STAGE_PROGRESS = {stage: int(((i + 1) / len(APPLICATION_STAGES)) * 100) for i, stage in enumerate(APPLICATION_STAGES)}
+
 def calculate_progress(stage: str) -> int:
-    try:
-        return int(((APPLICATION_STAGES.index(stage) + 1) / len(APPLICATION_STAGES)) * 100)
-    except:
-        return 0
+    return STAGE_PROGRESS.get(stage, 0)
 
 def derive_tasks_from_data(lead_data: dict, stage: str) -> list:
     tasks = [{"id": "application", "title": "Complete application form", "description": "Submitted", "completed": True}]
@@ -398,14 +585,33 @@ def get_recruiter_info(owner_name: str) -> Optional[dict]:
         return {"name": str(owner_name), "title": "Recruitment Coordinator", "email": None}
     return None
 
+SESSION_SWEEP_INTERVAL = 60
+
+async def sweep_active_sessions():
+    """Backstop for handlers that never reached their cleanup: drop sessions older than JWT_EXPIRATION_DAYS."""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        cutoff = datetime.now() - timedelta(days=JWT_EXPIRATION_DAYS)
+        for session_id in [sid for sid, session in active_sessions.items() if session["started_at"] < cutoff]:
+            active_sessions.pop(session_id, None)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global http_client
+    log_listener.start()
     log("Starting Alfa Web Chatbot server...")
     init_db()
+    http_client = httpx.AsyncClient(http2=True, timeout=60.0, headers={"User-Agent": "fogo-chatbot"},
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64))
+    sweeper = asyncio.create_task(sweep_active_sessions())
     yield
+    sweeper.cancel()
     log("Shutting down server...")
+    await http_client.aclose()
+    db_conn.close()
+    log_listener.stop()
 
-app = FastAPI(title="Alfa Web Chatbot", lifespan=lifespan)
+app = FastAPI(title="Alfa Web Chatbot", lifespan=lifespan, default_response_class=ORJSONResponse)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 @app.get("/")
@@ -419,6 +625,7 @@ async def health():
 
 # Zoho CRM Webhook - Auto-invite new leads/contacts to Clerk
 ZOHO_WEBHOOK_SECRET = os.getenv("ZOHO_WEBHOOK_SECRET", "")  # Optional: for signature verification
+ZOHO_WEBHOOK_MAX_BYTES = 16_384
 import hmac
 import hashlib
 
@@ -442,10 +649,31 @@ async def zoho_webhook(request: Request):
     3. Trigger: On Create (for Leads and/or Contacts modules)
     4. Parameters: Add ${Leads.Email}, ${Leads.First_Name}, ${Leads.Last_Name}
        Or for Contacts: ${Contacts.Email}, ${Contacts.First_Name}, ${Contacts.Last_Name}
+    5. If ZOHO_WEBHOOK_SECRET is set, send an X-Zoho-Signature header holding the
+       hex HMAC-SHA256 of the request body
     """
     try:
+        # Reject oversized or unsigned payloads before reading or parsing all of it
+        try:
+            content_length = int(request.headers.get("content-length") or 0)
+        except ValueError:
+            return JSONResponse(status_code=400, content={"success": False, "error": "Invalid Content-Length"})
+        if content_length > ZOHO_WEBHOOK_MAX_BYTES:
+            return JSONResponse(status_code=413, content={"success": False, "error": "Payload too large"})
+        raw_body = b""
+        async for chunk in request.stream():
+            raw_body += chunk
+            if len(raw_body) > ZOHO_WEBHOOK_MAX_BYTES:
+                return JSONResponse(status_code=413, content={"success": False, "error": "Payload too large"})
+        if ZOHO_WEBHOOK_SECRET and not verify_zoho_webhook(raw_body, request.headers.get("X-Zoho-Signature", ""), ZOHO_WEBHOOK_SECRET):
+            logging.warning("Zoho webhook: invalid signature")
+            return JSONResponse(status_code=401, content={"success": False, "error": "Invalid signature"})
+        
         # Parse webhook payload
-        body = await request.json()
+        try:
+            body = orjson.loads(raw_body)
+        except orjson.JSONDecodeError:
+            return JSONResponse(status_code=400, content={"success": False, "error": "Invalid JSON"})
         logging.info(f"Zoho webhook received: {body}")
         
         # Extract email from payload - Zoho sends data in various formats
@@ -477,6 +705,9 @@ async def zoho_webhook(request: Request):
                 content={"success": False, "error": "No email in payload"}
             )
         
+        # The record was created or changed in Zoho, so cached lookups are stale
+        evict_crm_email(email)
+        
         # Check if Clerk SDK is available
         if not clerk_sdk:
             logging.error("Clerk SDK not initialized - cannot send invitation")
@@ -487,7 +718,7 @@ async def zoho_webhook(request: Request):
         
         # Check if user already exists in Clerk
         try:
-            existing_users = clerk_sdk.users.list(email_address=[email])
+            existing_users = await asyncio.to_thread(clerk_sdk.users.list, email_address=[email])
             if existing_users and len(existing_users.data) > 0:
                 logging.info(f"User {email} already exists in Clerk, skipping invitation")
                 return JSONResponse(
@@ -501,7 +732,8 @@ async def zoho_webhook(request: Request):
         
         # Create Clerk user silently (no notification)
         try:
-            clerk_sdk.users.create(
+            await asyncio.to_thread(
+                clerk_sdk.users.create,
                 email_address=[email],
                 first_name=first_name or "",
                 last_name=last_name or "",
@@ -537,6 +769,7 @@ async def zoho_webhook(request: Request):
 
 
 # Manual sync endpoint - for syncing existing CRM users to Clerk
+CLERK_LIST_BATCH = 100  # emails per Clerk users.list existence check
 @app.post("/api/sync-crm-to-clerk")
 async def sync_crm_to_clerk(request: Request):
     """Sync all existing Zoho CRM leads and contacts to Clerk silently."""
@@ -557,64 +790,80 @@ async def sync_crm_to_clerk(request: Request):
         headers = {"Authorization": f"Zoho-oauthtoken {access_token}"}
         results = {"leads": 0, "contacts": 0, "created": 0, "existing": 0, "errors": 0, "error_details": []}
         
-        async with httpx.AsyncClient() as client:
-            # Fetch Leads
-            resp = await client.post(
-                "https://www.zohoapis.com/crm/v8/coql",
-                headers=headers,
-                json={"select_query": "SELECT Email, First_Name, Last_Name FROM Leads WHERE Email is not null LIMIT 200"}
-            )
-            if resp.status_code == 200:
-                leads = resp.json().get("data", [])
-                results["leads"] = len(leads)
-            else:
-                leads = []
-            
-            # Fetch Contacts
-            resp = await client.post(
+        async def fetch_records(module: str) -> list:
+            resp = await http_client.post(
                 "https://www.zohoapis.com/crm/v8/coql",
                 headers=headers,
-                json={"select_query": "SELECT Email, First_Name, Last_Name FROM Contacts WHERE Email is not null LIMIT 200"}
+                json={"select_query": f"SELECT Email, First_Name, Last_Name FROM {module} WHERE Email is not null LIMIT 200"}
             )
             if resp.status_code == 200:
-                contacts = resp.json().get("data", [])
-                results["contacts"] = len(contacts)
-            else:
-                contacts = []
+                return orjson.loads(resp.content).get("data", [])
+            return []
+        
+        # Fetch Leads and Contacts concurrently
+        leads, contacts = await asyncio.gather(fetch_records("Leads"), fetch_records("Contacts"))
+        results["leads"] = len(leads)
+        results["contacts"] = len(contacts)
         
         # Combine and dedupe by email
         all_records = leads + contacts
         seen_emails = set()
-        
+        to_sync = []
         for record in all_records:
             email = record.get("Email")
             if not email or email.lower() in seen_emails:
                 continue
             seen_emails.add(email.lower())
-            
+            to_sync.append(record)
+        
+        semaphore = asyncio.Semaphore(10)  # Rate limit: at most 10 Clerk calls in flight
+        existing_emails = set()
+        created_rows = []  # (email, name, clerk_user_id) for save_synced_users
+        
+        async def check_existing(emails: list):
+            # One list call checks up to CLERK_LIST_BATCH emails at once
             try:
-                existing = clerk_sdk.users.list(request={"email_address": [email]})
-                if existing and len(existing.data) > 0:
-                    results["existing"] += 1
-                    continue
-                
-                clerk_sdk.users.create(
-                    email_address=[email],
-                    first_name=record.get("First_Name") or "",
-                    last_name=record.get("Last_Name") or "",
-                    skip_password_requirement=True,
-                    public_metadata={"source": "zoho_crm_sync"}
-                )
-                results["created"] += 1
-                logging.info(f"Created Clerk user: {email}")
-                await asyncio.sleep(0.5)  # Rate limit: wait between API calls
+                async with semaphore:
+                    found = await asyncio.to_thread(clerk_sdk.users.list, request={"email_address": emails, "limit": len(emails)})
+                for user in (found.data if found else []):
+                    for address in user.email_addresses or []:
+                        existing_emails.add(address.email_address.lower())
             except Exception as e:
-                error_msg = str(e)
-                if "already exists" in error_msg.lower() or "duplicate" in error_msg.lower():
-                    results["existing"] += 1
-                else:
-                    results["errors"] += 1
-                    results["error_details"].append({"email": email, "error": error_msg[:100]})
+                # Fall through: create() reports duplicates for anything we failed to check
+                logging.warning(f"Error checking existing Clerk users: {e}")
+        
+        emails = [record["Email"] for record in to_sync]
+        await asyncio.gather(*(check_existing(emails[i:i + CLERK_LIST_BATCH]) for i in range(0, len(emails), CLERK_LIST_BATCH)))
+        
+        async def sync_record(record: dict):
+            email = record["Email"]
+            async with semaphore:
+                try:
+                    user = await asyncio.to_thread(
+                        clerk_sdk.users.create,
+                        email_address=[email],
+                        first_name=record.get("First_Name") or "",
+                        last_name=record.get("Last_Name") or "",
+                        skip_password_requirement=True,
+                        public_metadata={"source": "zoho_crm_sync"}
+                    )
+                    results["created"] += 1
+                    name = f"{record.get('First_Name') or ''} {record.get('Last_Name') or ''}".strip()
+                    created_rows.append((email.lower(), name or None, user.id if user else None))
+                    logging.info(f"Created Clerk user: {email}")
+                except Exception as e:
+                    error_msg = str(e)
+                    if "already exists" in error_msg.lower() or "duplicate" in error_msg.lower():
+                        results["existing"] += 1
+                    else:
+                        results["errors"] += 1
+                        results["error_details"].append({"email": email, "error": error_msg[:100]})
+        
+        missing = [record for record in to_sync if record["Email"].lower() not in existing_emails]
+        results["existing"] += len(to_sync) - len(missing)
+        await asyncio.gather(*(sync_record(record) for record in missing))
+        if created_rows:
+            await asyncio.to_thread(save_synced_users, created_rows)
         
         return results
     except HTTPException:
@@ -629,16 +878,16 @@ async def get_candidate_data(request: Request):
     if not auth_header or not auth_header.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Not authenticated")
     token = auth_header.split(" ")[1]
-    payload = await verify_clerk_token(token) if clerk_sdk else None
+    payload = await verify_clerk_token_warming_zoho(token)
     if not payload:
         payload = verify_jwt_token(token)
     if not payload:
         raise HTTPException(status_code=401, detail="Invalid token")
     email = payload["email"]
-    crm_data, user_type = await verify_email_in_crm(email)
+    crm_data, user_type = await fetch_candidate(email)
     if not crm_data:
         raise HTTPException(status_code=403, detail="Email not registered in CRM")
-    lead_data = await get_lead_with_documents(email)
+    lead_data = crm_data if user_type == "candidate" else None
     if not lead_data:
         return {"name": payload.get("name", email), "email": email, "language": None, "stage": None,
                 "progress_percent": 0, "upcoming": None, "tasks": [], "documents": [], "recruiter": None}
@@ -651,119 +900,211 @@ async def get_candidate_data(request: Request):
         "recruiter": get_recruiter_info(lead_data.get("Candidate_Recruitment_Owner"))
     }
 
+async def websocket_sender(websocket: WebSocket, out_queue: asyncio.Queue):
+    """Drain a connection's outgoing queue so the receive loop never waits on socket writes.
+
+    Frames go out as binary orjson bytes; the client decodes them as UTF-8 JSON.
+    """
+    while True:
+        message = await out_queue.get()
+        await websocket.send_bytes(orjson.dumps(message))
+
+def log_sender_exit(sender: asyncio.Task):
+    if not sender.cancelled() and sender.exception():
+        debug(f"WebSocket sender stopped: {sender.exception()!r}")
+
+@contextmanager
+def websocket_session(websocket: WebSocket):
+    """Own a connection's session id and sender task; both are torn down however the handler exits.
+
+    Yields (session_id, send). send() enqueues a frame and raises WebSocketDisconnect
+    once the sender has died, so a dropped client ends the handler instead of blocking it.
+    """
+    session_id = str(uuid.uuid4())
+    out_queue = asyncio.Queue(maxsize=64)
+    sender = asyncio.create_task(websocket_sender(websocket, out_queue))
+    sender.add_done_callback(log_sender_exit)
+
+    async def send(message: dict):
+        if sender.done():
+            raise WebSocketDisconnect(code=1006)
+        if not out_queue.full():
+            out_queue.put_nowait(message)
+            return
+        # Queue is full: wait for room, but give up if the sender dies meanwhile
+        put = asyncio.ensure_future(out_queue.put(message))
+        await asyncio.wait({put, sender}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            raise WebSocketDisconnect(code=1006)
+
+    try:
+        yield session_id, send
+    finally:
+        active_sessions.pop(session_id, None)
+        sender.cancel()
+
 @app.websocket("/chat")
 async def websocket_chat(websocket: WebSocket):
     await websocket.accept()
-    session_id = str(uuid.uuid4())
-    user_data = None
-    user_id = None
-    language = "en"
-    messages = []
-    conversation_id = None
-    debug(f"New WebSocket connection: {session_id}")
-    try:
-        while True:
-            data = await websocket.receive_json()
-            if data.get("type") == "auth":
-                token = data.get("token")
-                language = data.get("language", "en")
-                if token:
-                    payload = await verify_clerk_token(token) if clerk_sdk else None
-                    if payload:
-                        email = payload["email"]
-                        clerk_user_id = payload.get("clerk_user_id")
-                        name = payload.get("name", email)
-                        picture = payload.get("picture")
-                        crm_data, user_type = await verify_email_in_crm(email)
-                        if not crm_data:
-                            log(f"Access denied: {email} not found in CRM")
-                            await websocket.send_json({"type": "auth_failed", "reason": "email_not_registered",
-                                "message": "This email is not registered. Please complete the interpreter application form first."})
-                            continue
-                        crm_id = crm_data.get("id")
-                        user_id = create_or_update_user(email, name, picture, clerk_user_id, crm_id, crm_data)
+    with websocket_session(websocket) as (session_id, send):
+        user_data = None
+        user_id = None
+        language = "en"
+        messages = []
+        conversation_id = None
+        saved_count = 0
+        debug(f"New WebSocket connection: {session_id}")
+        try:
+            while True:
+                data = orjson.loads(await websocket.receive_text())
+                if data.get("type") == "auth":
+                    token = data.get("token")
+                    language = data.get("language", "en")
+                    session_token = data.get("session_token")
+                    identity = verify_session_token(session_token, token) if token else None
+                    if token and not identity:
+                        session_token = None
+                        payload = await verify_clerk_token_warming_zoho(token)
+                        if payload:
+                            email = payload["email"]
+                            clerk_user_id = payload.get("clerk_user_id")
+                            name = payload.get("name", email)
+                            picture = payload.get("picture")
+                            crm_data, user_type = await verify_email_in_crm(email)
+                            if not crm_data:
+                                log(f"Access denied: {email} not found in CRM")
+                                await send({"type": "auth_failed", "reason": "email_not_registered",
+                                    "message": "This email is not registered. Please complete the interpreter application form first."})
+                                continue
+                            crm_id = crm_data.get("id")
+                            user_id = await asyncio.to_thread(create_or_update_user, email, name, picture, clerk_user_id, crm_id, crm_data)
+                            identity = {"user_id": user_id, "email": email, "name": name, "picture": picture,
+                                        "clerk_user_id": clerk_user_id, "user_type": user_type, "crm_data": crm_data}
+                    if identity:
+                        email, name, picture, crm_data = identity["email"], identity["name"], identity.get("picture"), identity["crm_data"]
+                        if identity["user_id"] != user_id:
+                            # A different user on this socket must not inherit the previous user's conversation
+                            messages = []
+                            conversation_id = None
+                            saved_count = 0
+                        user_id = identity["user_id"]
                         user_data = {"id": user_id, "email": email, "name": name, "crm_data": crm_data}
-                        active_sessions[session_id] = {"user_id": user_id, "language": language}
+                        active_sessions[session_id] = {"user_id": user_id, "language": language, "started_at": datetime.now()}
                         first_name = name.split()[0] if name else "there"
                         welcome = f"Hola {first_name}!" if language == "es" else f"Hello {first_name}! How can I help you today?"
-                        await websocket.send_json({"type": "auth_success", "user": {"email": email, "name": name, "picture": picture, "crm_data": crm_data}})
-                        await websocket.send_json({"type": "message", "content": welcome})
+                        await send({"type": "auth_success", "user": {"email": email, "name": name, "picture": picture, "crm_data": crm_data},
+                            "session_token": session_token or create_session_token(identity)})
+                        await send({"type": "message", "content": welcome})
                         messages.append({"role": "assistant", "content": welcome})
-                        log(f"User authenticated: {email} ({user_type})")
+                        log(f"User authenticated: {email} ({identity['user_type']}){' via session token' if session_token else ''}")
                         continue
-                await websocket.send_json({"type": "auth_failed", "reason": "invalid_token"})
-                continue
-            if data.get("type") == "set_language":
-                language = data.get("language", "en")
-                continue
-            if data.get("type") == "message":
-                user_message = data.get("content", "")
-                if not user_message:
+                    await send({"type": "auth_failed", "reason": "invalid_token"})
                     continue
-                debug(f"[{session_id}] User: {user_message}")
-                messages.append({"role": "user", "content": user_message})
-                await websocket.send_json({"type": "typing", "status": True})
-                response = await get_chat_response(messages, user_data, language)
-                messages.append({"role": "assistant", "content": response})
-                if user_id:
-                    conversation_id = save_conversation(user_id, messages, conversation_id)
-                debug(f"[{session_id}] Assistant: {response[:100]}...")
-                await websocket.send_json({"type": "message", "content": response})
-            if data.get("type") == "new_conversation":
-                messages = []
-                conversation_id = None
-    except WebSocketDisconnect:
-        debug(f"Session disconnected: {session_id}")
-        if session_id in active_sessions:
-            del active_sessions[session_id]
-    except Exception as e:
-        log(f"WebSocket error: {e}")
-        if session_id in active_sessions:
-            del active_sessions[session_id]
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8006)
+                if data.get("type") == "set_language":
+                    language = data.get("language", "en")
+                    continue
+                if data.get("type") == "message":
+                    user_message = data.get("content", "")
+                    if not user_message:
+                        continue
+                    debug(f"[{session_id}] User: {user_message}")
+                    messages.append({"role": "user", "content": user_message})
+                    await send({"type": "typing", "status": True})
+                    response = await get_chat_response(messages, user_data, language,
+                        lambda delta: send({"type": "message_delta", "content": delta}))
+                    messages.append({"role": "assistant", "content": response})
+                    if user_id:
+                        conversation_id = await asyncio.to_thread(save_conversation, user_id, messages[saved_count:], conversation_id, saved_count)
+                        saved_count = len(messages)
+                    debug(f"[{session_id}] Assistant: {response[:100]}...")
+                    await send({"type": "message", "content": response})
+                if data.get("type") == "new_conversation":
+                    messages = []
+                    conversation_id = None
+                    saved_count = 0
+        except WebSocketDisconnect:
+            debug(f"Session disconnected: {session_id}")
+        except Exception as e:
+            log(f"WebSocket error: {e}")
 
 # =============================================================================
 # Zoho Tasks Integration
 # =============================================================================
 
+TASKS_QUERY = "select id, Subject, Due_Date, Status, Priority from Tasks where What_Id = {lead_id} limit 20"
+COMPLETED_TASK_STATUSES = frozenset(("Completed", "Done"))
+TASKS_CACHE_TTL = 30
+TASKS_CACHE_SIZE = 1024
+tasks_cache = {}  # lead_id -> (tasks, expires_at)
+tasks_inflight = {}  # lead_id -> asyncio.Task, so concurrent misses share one Zoho call and its result
+
 async def get_tasks_for_lead(lead_id: str) -> list:
-    """Fetch tasks from Zoho CRM Tasks module related to a Lead."""
-    access_token = await get_zoho_access_token()
-    if not access_token or not lead_id:
+    """Fetch tasks from Zoho CRM Tasks module related to a Lead, cached for TASKS_CACHE_TTL seconds."""
+    # Zoho record ids are numeric; anything else would be spliced into the COQL unquoted
+    lead_id = str(lead_id or "")
+    if not lead_id.isdigit():
         return []
+    cached = tasks_cache.get(lead_id)
+    if cached and datetime.now() < cached[1]:
+        return cached[0]
+    fetch = tasks_inflight.get(lead_id)
+    if fetch is None:
+        fetch = asyncio.create_task(fetch_and_cache_tasks(lead_id))
+        tasks_inflight[lead_id] = fetch
+        fetch.add_done_callback(lambda task: tasks_inflight.pop(lead_id, None) if tasks_inflight.get(lead_id) is task else None)
+    # Shielded so one caller being cancelled doesn't cancel the fetch the others are waiting on
+    tasks = await asyncio.shield(fetch)
+    return tasks if tasks is not None else []
+
+async def fetch_and_cache_tasks(lead_id: str) -> Optional[list]:
+    """Fetch a Lead's tasks and cache them on success."""
+    tasks = await fetch_tasks_for_lead(lead_id)
+    if tasks is not None:
+        if len(tasks_cache) >= TASKS_CACHE_SIZE:
+            tasks_cache.pop(next(iter(tasks_cache)))
+        tasks_cache[lead_id] = (tasks, datetime.now() + timedelta(seconds=TASKS_CACHE_TTL))
+    return tasks
+
+async def fetch_tasks_for_lead(lead_id: str) -> Optional[list]:
+    """Query Zoho for a Lead's tasks. Returns None when the lookup fails."""
+    access_token = await get_zoho_access_token()
+    if not access_token:
+        return None
     
-    query = f"select id, Subject, Due_Date, Status, Priority, Description from Tasks where What_Id = {lead_id} limit 20"
+    query = TASKS_QUERY.format(lead_id=lead_id)
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://www.zohoapis.com/crm/v8/coql",
-                headers={
-                    "Authorization": f"Zoho-oauthtoken {access_token}",
-                    "Content-Type": "application/json"
-                },
-                json={"select_query": query}
-            )
-            data = response.json()
-            
-            if "data" in data:
-                tasks = []
-                for task in data["data"]:
-                    status = task.get("Status", "")
-                    tasks.append({
-                        "id": task.get("id"),
-                        "title": task.get("Subject", "Untitled Task"),
-                        "description": task.get("Description", ""),
-                        "due_date": task.get("Due_Date"),
-                        "priority": task.get("Priority", "Normal"),
-                        "status": status,
-                        "completed": status in ["Completed", "Done"]
-                    })
-                return tasks
-            return []
-    except Exception as e:
+        response = await http_client.post(
+            "https://www.zohoapis.com/crm/v8/coql",
+            headers={
+                "Authorization": f"Zoho-oauthtoken {access_token}",
+                "Content-Type": "application/json"
+            },
+            json={"select_query": query},
+            timeout=10.0
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
         log(f"Error fetching tasks: {e}")
+        return None
+    
+    # COQL answers 204 with an empty body when nothing matches
+    if response.status_code == 204:
         return []
+    data = orjson.loads(response.content)
+    return [
+        {
+            "id": task.get("id"),
+            "title": task.get("Subject") or "Untitled Task",
+            "due_date": task.get("Due_Date"),
+            "priority": task.get("Priority") or "Normal",
+            "status": (status := task.get("Status", "")),
+            "completed": status in COMPLETED_TASK_STATUSES
+        }
+        for task in data.get("data") or []
+    ]
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8006)
@@ -46,6 +46,8 @@ const APPLICATION_STAGES = [
     { key: "Interpreter Ready for Production", label: "Ready", labelEs: "Listo" }
 ];
 
+const utf8Decoder = new TextDecoder();
+
 class ChatApp {
     constructor() {
         this.socket = null;
@@ -54,6 +56,7 @@ class ChatApp {
         this.language = localStorage.getItem("chat_language") || "en";
         this.isConnected = false;
         this.isConnecting = false;
+        this.streaming = null;
         this.clerkMounted = false;
         this.authHandled = false;
         
@@ -311,27 +314,35 @@ class ChatApp {
         
         const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
         this.socket = new WebSocket(protocol + "//" + window.location.host + "/chat");
+        this.socket.binaryType = "arraybuffer";
         
         this.socket.onopen = () => {
             this.isConnected = true;
             this.isConnecting = false;
             this.setInputEnabled(true);
-            this.socket.send(JSON.stringify({ type: "auth", token: token, language: this.language }));
+            this.socket.send(JSON.stringify({ type: "auth", token: token, language: this.language,
+                session_token: sessionStorage.getItem("chat_session_token") }));
         };
         
         this.socket.onmessage = (event) => {
-            const data = JSON.parse(event.data);
+            // The server sends JSON as binary UTF-8 frames
+            const data = JSON.parse(typeof event.data === "string" ? event.data : utf8Decoder.decode(event.data));
             if (data.type === "auth_success") {
+                if (data.session_token) sessionStorage.setItem("chat_session_token", data.session_token);
                 this.showQuickActions();
             } else if (data.type === "auth_failed") {
+                sessionStorage.removeItem("chat_session_token");
                 if (data.reason === "email_not_registered") {
                     window.Clerk?.signOut();
                     this.showSignIn();
                     this.showAuthError(i18n[this.language].emailNotRegistered, true);
                 }
+            } else if (data.type === "message_delta") {
+                this.hideTypingIndicator();
+                this.appendStreamingText(data.content);
             } else if (data.type === "message") {
                 this.hideTypingIndicator();
-                this.addMessage(data.content, "assistant");
+                this.finishStreamingMessage(data.content);
             } else if (data.type === "typing" && data.status) {
                 this.showTypingIndicator();
             }
@@ -340,6 +351,8 @@ class ChatApp {
         this.socket.onclose = () => {
             this.isConnected = false;
             this.isConnecting = false;
+            // A reply cut off by the drop stays as it is; later messages get their own bubble
+            this.streaming = null;
             this.setInputEnabled(false);
             setTimeout(() => { if (this.clerkUser && !this.isConnected) this.connect(); }, 3000);
         };
@@ -363,6 +376,27 @@ class ChatApp {
             <div class="message-time">${new Date().toLocaleTimeString([], {hour: "2-digit", minute: "2-digit"})}</div>`;
         this.messagesContainer.appendChild(div);
         this.messagesContainer.scrollTop = this.messagesContainer.scrollHeight;
+        return div;
+    }
+    
+    appendStreamingText(delta) {
+        if (!this.streaming) {
+            const div = this.addMessage("", "assistant");
+            this.streaming = { el: div.querySelector(".message-content"), text: "" };
+        }
+        this.streaming.text += delta;
+        this.streaming.el.innerHTML = this.streaming.text.replace(/\n/g, "<br>");
+        this.messagesContainer.scrollTop = this.messagesContainer.scrollHeight;
+    }
+    
+    finishStreamingMessage(content) {
+        // The final message frame carries the full reply; it replaces whatever was streamed
+        if (this.streaming) {
+            this.streaming.el.innerHTML = content.replace(/\n/g, "<br>");
+            this.streaming = null;
+        } else {
+            this.addMessage(content, "assistant");
+        }
     }
     
     showQuickActions() { this.quickActions.style.display = "flex"; }
@@ -381,13 +415,17 @@ class ChatApp {
     newConversation() {
         if (this.socket && this.isConnected) {
             this.messagesContainer.innerHTML = "";
+            this.streaming = null;
             this.showQuickActions();
             this.socket.send(JSON.stringify({ type: "new_conversation" }));
         }
     }
 }
 
-async function logout() { if (window.Clerk) await window.Clerk.signOut(); }
+async function logout() {
+    sessionStorage.removeItem("chat_session_token");
+    if (window.Clerk) await window.Clerk.signOut();
+}
 function newConversation() { window.chatApp?.newConversation(); }
 function handleQuickAction(action) { window.chatApp?.handleQuickAction(action); }
 function toggleMobileSidebar() {